@@ -485,10 +485,13 @@ class Geometry:
         for arg1, arg2, _ in zip(cost_matrices, kernel_matrices, range(size)))
 
   def tree_flatten(self):
+    # relative_epsilon is kept as static metadata, since it is used in Python
+    # control flow, and scale is kept so that a copied epsilon is preserved.
     return (self._cost_matrix, self._kernel_matrix, self._epsilon_init,
-            self._relative_epsilon, self._kwargs), None
+            self._scale, self._kwargs), self._relative_epsilon
 
   @classmethod
   def tree_unflatten(cls, aux_data, children):
-    del aux_data
-    return cls(*children[:-1], **children[-1])
+    cost_matrix, kernel_matrix, epsilon, scale, kwargs = children
+    return cls(cost_matrix, kernel_matrix, epsilon=epsilon,
+               relative_epsilon=aux_data, scale=scale, **kwargs)
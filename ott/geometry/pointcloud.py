@@ -240,7 +240,12 @@ class PointCloud(geometry.Geometry):
     """Instantiates the geometries used for a divergence computation."""
     x, y = args
     couples = [(x, y), (x, x)] if static_b else [(x, y), (x, x), (y, y)]
-    return tuple(cls(*xy, **kwargs) for xy in couples)
+    geometries = tuple(cls(*xy, **kwargs) for xy in couples[:2])
+    if static_b:
+      return geometries
+    # When comparing a point cloud to itself, (y,y) is the same as (x,x).
+    geometry_yy = geometries[1] if y is x else cls(*couples[2], **kwargs)
+    return geometries + (geometry_yy,)
 
   def tree_flatten(self):
     return ((self.x, self.y, self._epsilon, self._cost_fn),
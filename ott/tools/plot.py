@@ -19,9 +19,10 @@ from typing import Union, List
 import warnings
 
 import jax.numpy as jnp
+from matplotlib import collections
 import matplotlib.pyplot as plt
+import numpy as np
 from ott.tools import transport
-import scipy
 
 try:
   from PIL import Image
@@ -38,11 +39,12 @@ except ImportError:
 
 def bidimensional(x: jnp.ndarray, y: jnp.ndarray):
   """Applies PCA to reduce to bimensional data."""
+  x, y = np.asarray(x), np.asarray(y)
   if x.shape[1] < 3:
     return x, y
 
-  u, s, _ = scipy.sparse.linalg.svds(jnp.concatenate([x, y], axis=0), k=2)
-  proj = u * s
+  u, s, _ = np.linalg.svd(np.concatenate([x, y], axis=0), full_matrices=False)
+  proj = u[:, :2] * s[:2]
   k = x.shape[0]
   return proj[:k], proj[k:]
 
@@ -57,26 +59,30 @@ def _couplings(ax,
                scale: int = 200,
                cmap: str = 'Purples'):
   """Plots 2-D couplings. Projects via PCA if data is higher dimensional."""
+  # Plotting only involves small arrays, which are handled on host with numpy.
   x, y = bidimensional(x, y)
+  a, b, matrix = np.asarray(a), np.asarray(b), np.asarray(matrix)
 
-  sa, sb = jnp.min(a) / scale, jnp.min(b) / scale
+  sa, sb = np.min(a) / scale, np.min(b) / scale
   ax.scatter(*x.T, s=a / sa, edgecolors='k', marker='o', label='x')
   ax.scatter(*y.T, s=b / sb, edgecolors='k', marker='X', label='y')
 
   cmap = plt.get_cmap(cmap)
-  u, v = jnp.where(matrix > threshold)
-  c = matrix[jnp.where(matrix > threshold)]
-  xy = jnp.concatenate([x[u], y[v]], axis=-1)
-  for i in range(xy.shape[0]):
-    strength = jnp.max(jnp.array(matrix.shape)) * c[i]
-    ax.plot(
-        xy[i, [0, 2]],
-        xy[i, [1, 3]],
-        linewidth=0.5 + 4 * strength,
-        color=cmap(strength),
-        zorder=0,
-        alpha=0.7,
-    )
+  u, v = np.nonzero(matrix > threshold)
+  c = matrix[u, v]
+  # All segments, of shape (num_segments, 2 points, 2 coordinates), are drawn
+  # with a single collection rather than one line per coupling entry.
+  segments = np.stack([x[u], y[v]], axis=1)
+  strength = float(max(matrix.shape)) * c
+  colors = cmap(strength)  # RGBA values of all segments, of shape (n, 4).
+  ax.add_collection(
+      collections.LineCollection(
+          segments,
+          linewidths=0.5 + 4 * strength,
+          colors=colors,
+          zorder=0,
+          alpha=0.7,
+      ))
   ax.legend(fontsize=15)
   return ax
 
@@ -106,9 +112,10 @@ def _barycenters(ax,
                  matrix: jnp.ndarray,
                  scale: int = 200):
   """Plots 2-D sinkhorn barycenters."""
-  sa, sb = jnp.min(a) / scale, jnp.min(b) / scale
+  y, a, b, matrix = (np.asarray(arr) for arr in (y, a, b, matrix))
+  sa, sb = np.min(a) / scale, np.min(b) / scale
   ax.scatter(*y.T, s=b / sb, edgecolors='k', marker='X', label='y')
-  tx = 1 / a[:, None] * jnp.matmul(matrix, y)
+  tx = 1 / a[:, None] * np.matmul(matrix, y)
   ax.scatter(*tx.T, s=a / sa, edgecolors='k', marker='X', label='T(x)')
   ax.legend(fontsize=15)
 
@@ -141,14 +148,15 @@ def animate(image_fns: List[str],
         RuntimeWarning,
     )
     return
-  images = [Image.open(image_fn) for image_fn in image_fns]
-  images[0].save(
-      gif_fn,
-      save_all=True,
-      append_images=images[1:],
-      duration=duration,
-      loop=0,
-  )
+  # Frames after the first one are opened lazily, as they get appended.
+  with Image.open(image_fns[0]) as first_image:
+    first_image.save(
+        gif_fn,
+        save_all=True,
+        append_images=(Image.open(image_fn) for image_fn in image_fns[1:]),
+        duration=duration,
+        loop=loop,
+    )
 
 
 def show_gif(gif_fn):
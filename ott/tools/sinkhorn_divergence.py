@@ -16,10 +16,13 @@
 """Implements the sinkhorn divergence."""
 
 import collections
+import functools
 from typing import Any, Dict, Optional, Type
+import warnings
 
 import jax
 from jax import numpy as jnp
+import numpy as np
 from ott.core import sinkhorn
 from ott.geometry import geometry
 from ott.geometry import pointcloud
@@ -28,6 +31,9 @@ SinkhornDivergenceOutput = collections.namedtuple(
     'SinkhornDivergenceOutput',
     ['divergence', 'potentials', 'geoms', 'errors', 'converged'])
 
+# Weights of the regularized OT costs of the (x,y), (x,x) and (y,y) terms.
+_DIVERGENCE_WEIGHTS = (1.0, -0.5, -0.5)
+
 
 def sinkhorn_divergence(
     geom: Type[geometry.Geometry],
@@ -35,8 +41,12 @@ def sinkhorn_divergence(
     a: Optional[jnp.ndarray] = None,
     b: Optional[jnp.ndarray] = None,
     sinkhorn_kwargs: Optional[Dict[str, Any]] = None,
+    symmetric_sinkhorn_kwargs: Optional[Dict[str, Any]] = None,
+    n_iters: Optional[int] = None,
     static_b: bool = False,
     share_epsilon: bool = True,
+    jit: bool = False,
+    cache_geometries: bool = False,
     **kwargs):
   """Computes Sinkhorn divergence defined by a geometry, weights, parameters.
 
@@ -50,7 +60,22 @@ def sinkhorn_divergence(
       all elements of b must match that of a to converge.
     sinkhorn_kwargs: Optionally a dict containing the keywords arguments for
       calls to the `sinkhorn` function, that is called twice if static_b else
-      three times.
+      three times. Unless set otherwise, ``use_danskin`` is True, i.e.
+      gradients of the divergence do not flow through the optimal potentials,
+      even when differentiating by unrolling Sinkhorn iterations. This is
+      exact at convergence, but should be set to False when computing higher
+      order derivatives.
+    symmetric_sinkhorn_kwargs: Optionally a dict of keywords arguments that
+      only apply to the calls to `sinkhorn` for the symmetric (x,x) and (y,y)
+      terms. These override both ``sinkhorn_kwargs`` and the defaults used for
+      those terms (parallel dual updates with a momentum of 0.5).
+    n_iters: if not None, sets both ``min_iterations`` and ``max_iterations``
+      of all calls to `sinkhorn` to that value. Sinkhorn iterations are then
+      run with a ``jax.lax.scan`` rather than a ``jax.lax.while_loop``, which is
+      faster to compile and run under ``jit`` or ``vmap``, at the expense of
+      running exactly ``n_iters`` iterations regardless of ``threshold``.
+      ``n_iters`` is ignored, with a warning, if either bound is already
+      specified in ``sinkhorn_kwargs``.
     static_b: if True, divergence of measure b against itself is NOT computed
     share_epsilon: if True, enforces that the same epsilon regularizer is shared
       for all 2 or 3 terms of the Sinkhorn divergence. In that case, the epsilon
@@ -58,31 +83,195 @@ def sinkhorn_divergence(
       geometry). This flag is set to True by default, because in the default
       setting, the epsilon regularization is a function of the mean of the cost
       matrix.
+    jit: if True, the computation of the divergence from the geometries, i.e.
+      all calls to `sinkhorn` and their combination, is compiled as a single
+      function. Keyword arguments to `sinkhorn` are then static and must be
+      hashable, with the exception of (possibly nested) dicts of hashable
+      values.
+    cache_geometries: if True, the geometries instantiated for the divergence
+      are cached, and reused by later calls with the same array objects. This
+      saves rebuilding geometries and recomputing the scale of a shared
+      epsilon, when the divergence is evaluated repeatedly on the same inputs.
+      Caching only applies when ``args`` are concrete jax arrays, i.e. neither
+      numpy arrays nor traced values, and ``kwargs`` are hashable. The cache
+      keeps references to the input arrays and geometries of the last 8
+      distinct calls, which can be released with ``clear_geometries_cache``.
     **kwargs: keywords arguments to the generic class. This is specific to each
       geometry.
 
   Returns:
-    tuple: (sinkhorn divergence value, three pairs of potentials, three costs)
+    tuple: (sinkhorn divergence value, three pairs of potentials, three costs),
+    where only two pairs of potentials and costs are returned if the (y,y) term
+    is not computed, e.g. when static_b is True.
   """
-  geometries = geom.prepare_divergences(*args, static_b=static_b, **kwargs)
-  geometries = (geometries + (None,) * max(0, 3 - len(geometries)))[:3]
-  if share_epsilon:
-    for geom in filter(None, geometries[1:(2 if static_b else 3)]):
-      geom.copy_epsilon(geometries[0])
+  geometries = _prepare_divergences(
+      geom, *args, static_b=static_b, share_epsilon=share_epsilon,
+      cache=cache_geometries, **kwargs)
 
   num_a, num_b = geometries[0].shape
+  # If (x,x) and (y,y) share the same geometry, default weights are shared too,
+  # so that the (y,y) term can reuse the solution of the (x,x) term.
+  default_b_is_a = a is None and b is None and geometries[2] is geometries[1]
   a = jnp.ones((num_a,)) / num_a if a is None else a
-  b = jnp.ones((num_b,)) / num_b if b is None else b
-  div_kwargs = {} if sinkhorn_kwargs is None else sinkhorn_kwargs
+  if b is None:
+    b = a if default_b_is_a else jnp.ones((num_b,)) / num_b
+  div_kwargs = {} if sinkhorn_kwargs is None else dict(sinkhorn_kwargs)
+  div_kwargs.setdefault('use_danskin', True)
+  if n_iters is not None:
+    if 'min_iterations' in div_kwargs or 'max_iterations' in div_kwargs:
+      warnings.warn(
+          'n_iters is ignored, since min_iterations or max_iterations is '
+          'passed in sinkhorn_kwargs.', RuntimeWarning)
+    else:
+      div_kwargs.update(min_iterations=n_iters, max_iterations=n_iters)
+      if 'threshold' in div_kwargs:
+        warnings.warn(
+            'A fixed number of Sinkhorn iterations is used, the threshold '
+            'passed in sinkhorn_kwargs is ignored.', RuntimeWarning)
+  div_kwargs.update(symmetric_sinkhorn_kwargs=symmetric_sinkhorn_kwargs)
+  if jit:
+    # Object identities are lost when tracing, hence passed as a static flag.
+    yy_is_xx = geometries[2] is geometries[1] and b is a
+    return _jit_sinkhorn_divergence(
+        *geometries, a, b, _freeze_kwargs(div_kwargs), yy_is_xx)
   return _sinkhorn_divergence(*geometries, a, b, **div_kwargs)
 
 
+# Geometries instantiated for the most recent divergence computations, keyed on
+# the identity of the arrays they were built from. Each entry also holds these
+# arrays, so that their ids cannot be reused while the entry is cached. As a
+# consequence, up to _GEOMETRIES_CACHE_SIZE sets of input arrays and geometries
+# (including dense cost matrices) are kept in memory until evicted or cleared.
+_GEOMETRIES_CACHE_SIZE = 8
+_geometries_cache = collections.OrderedDict()
+
+
+def clear_geometries_cache():
+  """Clears the geometries cached by `sinkhorn_divergence`."""
+  _geometries_cache.clear()
+
+
+def _geometries_cache_key(geom, args, kwargs, static_b, share_epsilon):
+  """Returns a key to cache geometries, or None if they cannot be cached."""
+  # Only concrete jax arrays are immutable, and tracers must not leak out of
+  # their trace. numpy arrays, which can be modified in place, are excluded
+  # explicitly since they may pass as instances of jnp.ndarray.
+  if not all(isinstance(arg, jnp.ndarray) and
+             not isinstance(arg, (np.ndarray, jax.core.Tracer))
+             for arg in args):
+    return None
+  if any(isinstance(v, jax.core.Tracer) for v in kwargs.values()):
+    return None
+  # Geometry kwargs such as lists of cost matrices or array epsilons are not
+  # hashable, in which case geometries are not cached.
+  try:
+    key = (geom, tuple(id(arg) for arg in args), static_b, share_epsilon,
+           frozenset(kwargs.items()))
+    hash(key)
+  except TypeError:
+    return None
+  return key
+
+
+def _prepare_divergences(
+    geom: Type[geometry.Geometry],
+    *args,
+    static_b: bool = False,
+    share_epsilon: bool = True,
+    cache: bool = False,
+    **kwargs):
+  """Instantiates the 3 geometries of a divergence, possibly from a cache.
+
+  Args:
+    geom: a geometry class.
+    *args: arguments to the prepare_divergences method of ``geom``.
+    static_b: if True, the (y,y) geometry is not instantiated.
+    share_epsilon: if True, the epsilon of the (x,y) geometry is copied to the
+      other geometries.
+    cache: if True, geometries are looked up in, and stored to, the cache.
+    **kwargs: keywords arguments to the prepare_divergences method of ``geom``.
+
+  Returns:
+    a tuple of 3 geometries, the last one being None if not instantiated.
+  """
+  key = (_geometries_cache_key(geom, args, kwargs, static_b, share_epsilon)
+         if cache else None)
+  if key is not None and key in _geometries_cache:
+    _geometries_cache.move_to_end(key)
+    return _geometries_cache[key][1]
+
+  geometries = geom.prepare_divergences(*args, static_b=static_b, **kwargs)
+  geometries = (geometries + (None,) * max(0, 3 - len(geometries)))[:3]
+  if share_epsilon:
+    for symmetric_geom in filter(None, geometries[1:(2 if static_b else 3)]):
+      symmetric_geom.copy_epsilon(geometries[0])
+
+  if key is not None:
+    _geometries_cache[key] = (args, geometries)
+    if len(_geometries_cache) > _GEOMETRIES_CACHE_SIZE:
+      _geometries_cache.popitem(last=False)
+  return geometries
+
+
+class _FrozenDict(tuple):
+  """Hashable form of a dict, as a sorted tuple of (key, value) pairs."""
+
+
+def _freeze_kwargs(value):
+  """Recursively turns dicts into hashable tuples, see `_thaw_kwargs`."""
+  if isinstance(value, dict):
+    return _FrozenDict(
+        sorted((k, _freeze_kwargs(v)) for k, v in value.items()))
+  return value
+
+
+def _thaw_kwargs(value):
+  """Recovers (possibly nested) dicts frozen with `_freeze_kwargs`."""
+  if isinstance(value, _FrozenDict):
+    return {k: _thaw_kwargs(v) for k, v in value}
+  return value
+
+
+@functools.partial(jax.jit, static_argnums=(5, 6))
+def _jit_sinkhorn_divergence(
+    geometry_xy: geometry.Geometry,
+    geometry_xx: geometry.Geometry,
+    geometry_yy: Optional[geometry.Geometry],
+    a: jnp.ndarray,
+    b: jnp.ndarray,
+    frozen_kwargs,
+    yy_is_xx: bool = False):
+  """Jitted version of `_sinkhorn_divergence`, with static sinkhorn kwargs.
+
+  Geometries are passed as pytrees, so that compiled functions are reused
+  across geometries of the same class, shapes and static metadata.
+
+  Args:
+    geometry_xy: geometry between the views X and Y.
+    geometry_xx: geometry between elements of the view X.
+    geometry_yy: geometry between elements of the view Y, or None.
+    a: jnp.ndarray<float>[n]: the weight of each input point.
+    b: jnp.ndarray<float>[m]: the weight of each target point.
+    frozen_kwargs: arguments to `_sinkhorn_divergence`, frozen with
+      `_freeze_kwargs`.
+    yy_is_xx: whether geometry_yy and b are the same objects as geometry_xx
+      and a, in which case the (x,x) solution is reused for the (y,y) term.
+  Returns:
+    SinkhornDivergenceOutput named tuple.
+  """
+  if yy_is_xx:
+    geometry_yy, b = geometry_xx, a
+  return _sinkhorn_divergence(geometry_xy, geometry_xx, geometry_yy, a, b,
+                              **_thaw_kwargs(frozen_kwargs))
+
+
 def _sinkhorn_divergence(
     geometry_xy: geometry.Geometry,
     geometry_xx: geometry.Geometry,
     geometry_yy: Optional[geometry.Geometry],
     a: jnp.ndarray,
     b: jnp.ndarray,
+    symmetric_sinkhorn_kwargs: Optional[Dict[str, Any]] = None,
     **kwargs):
   """Computes the (unbalanced) sinkhorn divergence for the wrapper function.
 
@@ -95,52 +284,136 @@ def _sinkhorn_divergence(
     geometry_xx: a Cost object able to apply kernels with a certain epsilon,
     between elements of the view X.
     geometry_yy: a Cost object able to apply kernels with a certain epsilon,
-    between elements of the view Y.
+    between elements of the view Y, or None if that term is not computed.
     a: jnp.ndarray<float>[n]: the weight of each input point. The sum of
      all elements of b must match that of a to converge.
     b: jnp.ndarray<float>[m]: the weight of each target point. The sum of
      all elements of b must match that of a to converge.
+    symmetric_sinkhorn_kwargs: Arguments to sinkhorn that only apply to the
+      symmetric (x,x) and (y,y) terms, overriding those in ``kwargs``.
     **kwargs: Arguments to sinkhorn.
   Returns:
-    SinkhornDivergenceOutput named tuple.
+    SinkhornDivergenceOutput named tuple, whose potentials, geoms, errors and
+    converged fields have 2 entries if geometry_yy is None, 3 otherwise.
   """
   # When computing a Sinkhorn divergence, the (x,y) terms and (x,x) / (y,y)
   # terms are computed independently. The user might want to pass some
   # sinkhorn_kwargs to parameterize sinkhorn's behavior, but those should
   # only apply to the (x,y) part. For the (x,x) / (y,y) part we fall back
   # on a simpler choice (parallel_dual_updates + momentum 0.5) that is known
-  # to work well in such settings. In the future we might want to give some
-  # freedom on setting parameters for the (x,x)/(y,y) part.
+  # to work well in such settings, unless overridden by the user through
+  # symmetric_sinkhorn_kwargs.
   kwargs_symmetric = kwargs.copy()
   kwargs_symmetric.update(
       parallel_dual_updates=True,
       momentum=0.5,
       chg_momentum_from=0,
       anderson_acceleration=0)
+  if symmetric_sinkhorn_kwargs is not None:
+    kwargs_symmetric.update(symmetric_sinkhorn_kwargs)
 
   # Since symmetric terms are computed assuming a = b, the linear systems
   # arising in implicit differentiation (if used) of the potentials computed for
   # the symmetric parts should be marked as symmetric.
-  linear_solve_kwargs = kwargs_symmetric.pop('linear_solve_kwargs', {})
+  linear_solve_kwargs = dict(kwargs_symmetric.pop('linear_solve_kwargs', {}))
   linear_solve_kwargs.update(symmetric=True)
   kwargs_symmetric.update(linear_solve_kwargs=linear_solve_kwargs)
 
+  # Both symmetric problems share the same sinkhorn parameters. If they are the
+  # same problem, it is solved once. Otherwise, when their geometries have
+  # matching shapes and potentials are differentiated by unrolling, they are
+  # solved in a single vmapped call.
+  # When geometry_yy is None, the (y,y) term is skipped altogether, and all
+  # outputs only cover the (x,y) and (x,x) terms.
   out_xy = sinkhorn.sinkhorn(geometry_xy, a, b, **kwargs)
-  out_xx = sinkhorn.sinkhorn(geometry_xx, a, a, **kwargs_symmetric)
   if geometry_yy is None:
-    out_yy = sinkhorn.SinkhornOutput(None, None, 0, None, None)
+    out_xx = sinkhorn.sinkhorn(geometry_xx, a, a, **kwargs_symmetric)
+    out = (out_xy, out_xx)
+    geoms = (geometry_xy, geometry_xx)
   else:
-    out_yy = sinkhorn.sinkhorn(geometry_yy, b, b, **kwargs_symmetric)
-
-  div = (out_xy.reg_ot_cost - 0.5 * (out_xx.reg_ot_cost + out_yy.reg_ot_cost)
+    if geometry_yy is geometry_xx and b is a:
+      out_xx = sinkhorn.sinkhorn(geometry_xx, a, a, **kwargs_symmetric)
+      out_yy = out_xx
+    elif _can_batch(geometry_xx, geometry_yy,
+                    kwargs_symmetric.get('implicit_differentiation', True)):
+      out_xx, out_yy = _batched_symmetric_sinkhorn(
+          geometry_xx, geometry_yy, a, b, **kwargs_symmetric)
+    else:
+      out_xx = sinkhorn.sinkhorn(geometry_xx, a, a, **kwargs_symmetric)
+      out_yy = sinkhorn.sinkhorn(geometry_yy, b, b, **kwargs_symmetric)
+    out = (out_xy, out_xx, out_yy)
+    geoms = (geometry_xy, geometry_xx, geometry_yy)
+
+  reg_ot_costs = jnp.stack([s.reg_ot_cost for s in out])
+  weights = jnp.asarray(_DIVERGENCE_WEIGHTS[:len(out)], reg_ot_costs.dtype)
+  div = (jnp.dot(weights, reg_ot_costs)
          + 0.5 * geometry_xy.epsilon * (jnp.sum(a) - jnp.sum(b))**2)
-  out = (out_xy, out_xx, out_yy)
   return SinkhornDivergenceOutput(div, tuple([s.f, s.g] for s in out),
-                                  (geometry_xy, geometry_xx, geometry_yy),
+                                  geoms,
                                   tuple(s.errors for s in out),
                                   tuple(s.converged for s in out))
 
 
+def _can_batch(geometry_xx: geometry.Geometry,
+               geometry_yy: geometry.Geometry,
+               implicit_differentiation: bool = True) -> bool:
+  """Checks whether the two symmetric problems can be solved in one batch.
+
+  Batching is only carried out for point clouds with the same number of points
+  and static parameters, whose epsilon and cost function parameters have the
+  same structure, so that both geometries can be stacked as pytrees. Only their
+  attributes are compared, since flattening a point cloud may compute the mean
+  of its cost matrix to scale epsilon.
+
+  Batching is also skipped when potentials are differentiated implicitly, since
+  the custom VJP of the implicit Sinkhorn iterations does not support geometries
+  batched with ``vmap``.
+
+  Args:
+    geometry_xx: geometry between elements of the view X.
+    geometry_yy: geometry between elements of the view Y.
+    implicit_differentiation: whether the symmetric problems are solved with
+      implicit differentiation.
+
+  Returns:
+    True if both geometries can be stacked along a new leading axis.
+  """
+  if implicit_differentiation:
+    return False
+  if not (isinstance(geometry_xx, pointcloud.PointCloud) and
+          type(geometry_xx) is type(geometry_yy)):
+    return False
+  if (geometry_xx.x.shape != geometry_yy.x.shape or
+      geometry_xx.y.shape != geometry_yy.y.shape or
+      geometry_xx.power != geometry_yy.power or
+      geometry_xx._online != geometry_yy._online):
+    return False
+  params_xx, params_yy = [
+      (geom._epsilon_init, geom._kwargs, geom._cost_fn)
+      for geom in (geometry_xx, geometry_yy)]
+  leaves_xx, tree_xx = jax.tree_util.tree_flatten(params_xx)
+  leaves_yy, tree_yy = jax.tree_util.tree_flatten(params_yy)
+  return tree_xx == tree_yy and all(
+      jnp.shape(leaf_xx) == jnp.shape(leaf_yy)
+      for leaf_xx, leaf_yy in zip(leaves_xx, leaves_yy))
+
+
+def _batched_symmetric_sinkhorn(
+    geometry_xx: geometry.Geometry,
+    geometry_yy: geometry.Geometry,
+    a: jnp.ndarray,
+    b: jnp.ndarray,
+    **kwargs):
+  """Solves the (x,x) and (y,y) problems with a single vmapped sinkhorn call."""
+  geoms = jax.tree_util.tree_map(
+      lambda u, v: jnp.stack([u, v]), geometry_xx, geometry_yy)
+  out = jax.vmap(lambda geom, w: sinkhorn.sinkhorn(geom, w, w, **kwargs))(
+      geoms, jnp.stack([a, b]))
+  out_xx = jax.tree_util.tree_map(lambda z: z[0], out)
+  out_yy = jax.tree_util.tree_map(lambda z: z[1], out)
+  return out_xx, out_yy
+
+
 def segment_sinkhorn_divergence(x: jnp.ndarray,
                                 y: jnp.ndarray,
                                 segment_ids_x: Optional[jnp.ndarray] = None,
@@ -153,6 +426,9 @@ def segment_sinkhorn_divergence(x: jnp.ndarray,
                                 weights_y: Optional[jnp.ndarray] = None,
                                 sinkhorn_kwargs: Optional[Dict[str,
                                                                Any]] = None,
+                                symmetric_sinkhorn_kwargs: Optional[Dict[
+                                    str, Any]] = None,
+                                n_iters: Optional[int] = None,
                                 static_b: bool = False,
                                 share_epsilon: bool = True,
                                 **kwargs) -> jnp.ndarray:
@@ -192,6 +468,10 @@ def segment_sinkhorn_divergence(x: jnp.ndarray,
     sinkhorn_kwargs: Optionally a dict containing the keywords arguments for
       calls to the `sinkhorn` function, that is called twice if static_b else
       three times.
+    symmetric_sinkhorn_kwargs: Optionally a dict of keywords arguments that
+      only apply to the calls to `sinkhorn` for the symmetric terms.
+    n_iters: if not None, fixed number of iterations used in all calls to
+      `sinkhorn`, see `sinkhorn_divergence`.
     static_b: if True, divergence of measure b against itself is NOT computed
     share_epsilon: if True, enforces that the same epsilon regularizer is shared
       for all 2 or 3 terms of the Sinkhorn divergence. In that case, the epsilon
@@ -270,6 +550,8 @@ def segment_sinkhorn_divergence(x: jnp.ndarray,
         a=padded_weight_x,
         b=padded_weight_y,
         sinkhorn_kwargs=sinkhorn_kwargs,
+        symmetric_sinkhorn_kwargs=symmetric_sinkhorn_kwargs,
+        n_iters=n_iters,
         static_b=static_b,
         share_epsilon=share_epsilon,
         **kwargs).divergence
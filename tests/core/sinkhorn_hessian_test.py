@@ -26,9 +26,12 @@ from ott.tools import transport
 
 class SinkhornHessianTest(jax.test_util.JaxTestCase):
 
-  def setUp(self):
-    super().setUp()
-    self.rng = jax.random.PRNGKey(0)
+  @classmethod
+  def setUpClass(cls):
+    # Keys are shared across all parameterized tests, so only split once.
+    super().setUpClass()
+    cls.rng = jax.random.PRNGKey(0)
+    cls.rngs = jax.random.split(cls.rng, 6)
 
   @parameterized.product(
       lse_mode=[True, False],
@@ -42,7 +45,7 @@ class SinkhornHessianTest(jax.test_util.JaxTestCase):
     n, m = shape
 
     dim = 3
-    rngs = jax.random.split(self.rng, 6)
+    rngs = self.rngs
     x = jax.random.uniform(rngs[0], (n, dim))
     y = jax.random.uniform(rngs[1], (m, dim))
     a = jax.random.uniform(rngs[2], (n,)) +.1
@@ -71,13 +74,9 @@ class SinkhornHessianTest(jax.test_util.JaxTestCase):
     delta_x = jax.random.uniform(rngs[5], (n, dim))
 
     # Test that Hessians produced with either backprop or implicit do match.
-    hess_loss_imp = jax.jit(jax.hessian(lambda a, x: loss(a, x, True),
-                                        argnums=arg))
-    hess_imp = hess_loss_imp(a, x)
-
-    hess_loss_back = jax.jit(jax.hessian(lambda a, x: loss(a, x, False),
-                                         argnums=arg))
-    hess_back = hess_loss_back(a, x)
+    hess_loss = jax.jit(jax.hessian(loss, argnums=arg), static_argnums=2)
+    hess_imp = hess_loss(a, x, True)
+    hess_back = hess_loss(a, x, False)
 
     # In the balanced case, when studying differentiability w.r.t
     # weights, both Hessians must be the same,
@@ -94,16 +93,16 @@ class SinkhornHessianTest(jax.test_util.JaxTestCase):
     rel_dif_norm = dif_norm / jnp.sum(jnp.abs(hess_imp))
     self.assertGreater(0.1, rel_dif_norm)
 
+    grad_loss = jax.jit(jax.grad(loss, argnums=arg), static_argnums=2)
     for impl in [True, False]:
-      grad_ = jax.jit(jax.grad(lambda a, x: loss(a, x, impl), argnums=arg))
-      grad_init = grad_(a, x)
+      grad_init = grad_loss(a, x, impl)
 
       # Depending on variable tested, perturb either a or x.
       a_p = a + eps * delta_a if arg == 0 else a
       x_p = x if arg == 0 else x + eps * delta_x
 
       # Perturbed gradient.
-      grad_pert = grad_(a_p, x_p)
+      grad_pert = grad_loss(a_p, x_p, impl)
       grad_dif = (grad_pert-grad_init) / eps
       # Apply hessian to perturbation
       if arg == 0:
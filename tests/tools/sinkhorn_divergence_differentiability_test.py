@@ -26,16 +26,17 @@ from ott.tools import sinkhorn_divergence
 
 class SinkhornDivergenceGradTest(jax.test_util.JaxTestCase):
 
-  def setUp(self):
-    super().setUp()
-    self.rng = jax.random.PRNGKey(0)
-    self._dim = 3
-    self._num_points = 13, 12
-    self.rng, *rngs = jax.random.split(self.rng, 3)
-    a = jax.random.uniform(rngs[0], (self._num_points[0],))
-    b = jax.random.uniform(rngs[1], (self._num_points[1],))
-    self._a = a / jnp.sum(a)
-    self._b = b / jnp.sum(b)
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    cls.rng = jax.random.PRNGKey(0)
+    cls._dim = 3
+    cls._num_points = 13, 12
+    cls.rng, *rngs = jax.random.split(cls.rng, 3)
+    a = jax.random.uniform(rngs[0], (cls._num_points[0],))
+    b = jax.random.uniform(rngs[1], (cls._num_points[1],))
+    cls._a = a / jnp.sum(a)
+    cls._b = b / jnp.sum(b)
 
   def test_gradient_generic_point_cloud_wrapper(self):
     rngs = jax.random.split(self.rng, 3)
@@ -63,8 +64,9 @@ class SinkhornDivergenceGradTest(jax.test_util.JaxTestCase):
     self.assertFalse(jnp.any(jnp.isnan(grad_loss)))
 
     # second calculation of gradient
-    loss_delta_plus = loss_fn(x + eps * delta, y)
-    loss_delta_minus = loss_fn(x - eps * delta, y)
+    loss_fn_jit = jax.jit(loss_fn)
+    loss_delta_plus = loss_fn_jit(x + eps * delta, y)
+    loss_delta_minus = loss_fn_jit(x - eps * delta, y)
     finite_diff_grad = (loss_delta_plus - loss_delta_minus) / (2 * eps)
 
     self.assertAllClose(custom_grad, finite_diff_grad, rtol=1e-02, atol=1e-02)
@@ -21,6 +21,7 @@ from absl.testing import parameterized
 import jax
 import jax.numpy as jnp
 import jax.test_util
+import numpy as np
 from ott.geometry import geometry
 from ott.geometry import pointcloud
 from ott.tools import sinkhorn_divergence
@@ -28,16 +29,19 @@ from ott.tools import sinkhorn_divergence
 
 class SinkhornDivergenceTest(jax.test_util.JaxTestCase):
 
-  def setUp(self):
-    super().setUp()
-    self.rng = jax.random.PRNGKey(0)
-    self._dim = 4
-    self._num_points = 30, 37
-    self.rng, *rngs = jax.random.split(self.rng, 3)
-    a = jax.random.uniform(rngs[0], (self._num_points[0],))
-    b = jax.random.uniform(rngs[1], (self._num_points[1],))
-    self._a = a / jnp.sum(a)
-    self._b = b / jnp.sum(b)
+  @classmethod
+  def setUpClass(cls):
+    # Inputs are shared across (parameterized) tests, and jax arrays are
+    # immutable, so they are only generated once.
+    super().setUpClass()
+    cls.rng = jax.random.PRNGKey(0)
+    cls._dim = 4
+    cls._num_points = 30, 37
+    cls.rng, *rngs = jax.random.split(cls.rng, 3)
+    a = jax.random.uniform(rngs[0], (cls._num_points[0],))
+    b = jax.random.uniform(rngs[1], (cls._num_points[1],))
+    cls._a = a / jnp.sum(a)
+    cls._b = b / jnp.sum(b)
 
   def test_euclidean_point_cloud(self):
     rngs = jax.random.split(self.rng, 2)
@@ -62,6 +66,9 @@ class SinkhornDivergenceTest(jax.test_util.JaxTestCase):
         pointcloud.PointCloud, x, x, epsilon=1e-1,
         sinkhorn_kwargs={'inner_iterations': 1})
     self.assertAllClose(div.divergence, 0.0, rtol=1e-5, atol=1e-5)
+    # The (x,x) geometry and solution are reused for the (y,y) term.
+    self.assertIs(div.geoms[1], div.geoms[2])
+    self.assertIs(div.errors[1], div.errors[2])
     iters_xx = jnp.sum(div.errors[0] > 0)
     iters_xx_sym = jnp.sum(div.errors[1] > 0)
     self.assertGreater(iters_xx, iters_xx_sym)
@@ -134,10 +141,15 @@ class SinkhornDivergenceTest(jax.test_util.JaxTestCase):
     x = jax.random.uniform(rngs[0], (self._num_points[0], self._dim))
     y = jax.random.uniform(rngs[1], (self._num_points[1], self._dim))
 
+    def sqeuclidean(u, v):
+      # |u - v|^2 = |u|^2 + |v|^2 - 2 <u, v>, computed with a matrix product.
+      return (jnp.sum(u ** 2, axis=1)[:, jnp.newaxis] +
+              jnp.sum(v ** 2, axis=1)[jnp.newaxis, :] - 2 * jnp.dot(u, v.T))
+
     # Tests with 3 cost matrices passed as args
-    cxy = jnp.sum(jnp.abs(x[:, jnp.newaxis] - y[jnp.newaxis, :])**2, axis=2)
-    cxx = jnp.sum(jnp.abs(x[:, jnp.newaxis] - x[jnp.newaxis, :])**2, axis=2)
-    cyy = jnp.sum(jnp.abs(y[:, jnp.newaxis] - y[jnp.newaxis, :])**2, axis=2)
+    cxy = sqeuclidean(x, y)
+    cxx = sqeuclidean(x, x)
+    cyy = sqeuclidean(y, y)
     div = sinkhorn_divergence.sinkhorn_divergence(
         geometry.Geometry,
         cxy, cxx, cyy, epsilon=0.1,
@@ -154,8 +166,19 @@ class SinkhornDivergenceTest(jax.test_util.JaxTestCase):
         a=self._a, b=self._b,
         sinkhorn_kwargs=dict(threshold=1e-2))
     self.assertIsNotNone(div.divergence)
-    self.assertLen(div.potentials, 3)
-    self.assertLen(div.geoms, 3)
+    self.assertLen(div.potentials, 2)
+    self.assertLen(div.geoms, 2)
+    self.assertLen(div.errors, 2)
+
+    # Tests with static_b, which skips the (y,y) term.
+    div = sinkhorn_divergence.sinkhorn_divergence(
+        geometry.Geometry,
+        cxy, cxx, cyy, epsilon=0.1,
+        a=self._a, b=self._b, static_b=True,
+        sinkhorn_kwargs=dict(threshold=1e-2))
+    self.assertIsNotNone(div.divergence)
+    self.assertLen(div.potentials, 2)
+    self.assertLen(div.geoms, 2)
 
     # Tests with 3 cost matrices passed as kwargs
     div = sinkhorn_divergence.sinkhorn_divergence(
@@ -167,6 +190,48 @@ class SinkhornDivergenceTest(jax.test_util.JaxTestCase):
     self.assertLen(div.potentials, 3)
     self.assertLen(div.geoms, 3)
 
+  @parameterized.parameters([True, False])
+  def test_batched_symmetric_terms(self, implicit_differentiation):
+    # Clouds of the same size have their (x,x) and (y,y) terms solved in a
+    # single batch when differentiating by unrolling. Values and derivatives
+    # should match the unbatched cost matrix computation in all cases.
+    rngs = jax.random.split(self.rng, 2)
+    x = jax.random.uniform(rngs[0], (self._num_points[0], self._dim))
+    y = jax.random.uniform(rngs[1], (self._num_points[0], self._dim))
+    a = jnp.ones(self._num_points[0]) / self._num_points[0]
+    costs = [pointcloud.PointCloud(u, v).cost_matrix
+             for u, v in ((x, y), (x, x), (y, y))]
+    # Ridges stabilize the linear systems of implicit differentiation, whose
+    # Hessians w.r.t. balanced weights are otherwise ill-conditioned.
+    sinkhorn_kwargs = dict(
+        threshold=1e-5, use_danskin=False,
+        implicit_differentiation=implicit_differentiation,
+        linear_solve_kwargs={'ridge_kernel': 1e-4, 'ridge_identity': 1e-4})
+
+    def loss_point_cloud(a):
+      return sinkhorn_divergence.sinkhorn_divergence(
+          pointcloud.PointCloud, x, y, epsilon=0.1, a=a, b=self._a,
+          sinkhorn_kwargs=sinkhorn_kwargs).divergence
+
+    def loss_cost_matrix(a):
+      # epsilon is set for all terms, so it need not be shared.
+      return sinkhorn_divergence.sinkhorn_divergence(
+          geometry.Geometry, cost_matrix=costs, epsilon=0.1, a=a, b=self._a,
+          sinkhorn_kwargs=sinkhorn_kwargs, share_epsilon=False).divergence
+
+    div = sinkhorn_divergence.sinkhorn_divergence(
+        pointcloud.PointCloud, x, y, epsilon=0.1, a=a, b=self._a,
+        sinkhorn_kwargs=sinkhorn_kwargs)
+    self.assertLen(div.potentials, 3)
+    self.assertEqual(
+        sinkhorn_divergence._can_batch(div.geoms[1], div.geoms[2],
+                                       implicit_differentiation),
+        not implicit_differentiation)
+
+    for fn in (lambda f: f, jax.grad, jax.hessian):
+      self.assertAllClose(fn(loss_point_cloud)(a), fn(loss_cost_matrix)(a),
+                          rtol=1e-3, atol=1e-3)
+
   @parameterized.parameters([True, False])
   def test_segment_sinkhorn_result(self, shuffle):
     # Test that segmented sinkhorn gives the same results:
@@ -271,5 +336,159 @@ class SinkhornDivergenceTest(jax.test_util.JaxTestCase):
     self.assertGreater(threshold, div.errors[2][-1])
     self.assertGreater(div.divergence, 0.0)
 
+  def test_symmetric_sinkhorn_kwargs(self):
+    # check that parameters for the symmetric (x,x) and (y,y) parts can be set
+    # independently of those used for the (x,y) part.
+    rngs = jax.random.split(self.rng, 2)
+    cloud_a = jax.random.uniform(rngs[0], (self._num_points[0], self._dim))
+    cloud_b = jax.random.uniform(rngs[1], (self._num_points[1], self._dim))
+    sinkhorn_kwargs = dict(threshold=1e-3, inner_iterations=1)
+    div_default = sinkhorn_divergence.sinkhorn_divergence(
+        pointcloud.PointCloud, cloud_a, cloud_b, epsilon=1e-1,
+        a=self._a, b=self._b, sinkhorn_kwargs=sinkhorn_kwargs)
+    # Override the defaults of the symmetric parts with plain sinkhorn updates,
+    # which take more iterations to converge on symmetric problems.
+    div = sinkhorn_divergence.sinkhorn_divergence(
+        pointcloud.PointCloud, cloud_a, cloud_b, epsilon=1e-1,
+        a=self._a, b=self._b, sinkhorn_kwargs=sinkhorn_kwargs,
+        symmetric_sinkhorn_kwargs=dict(
+            parallel_dual_updates=False, momentum=1.0))
+
+    self.assertAllClose(div.errors[0], div_default.errors[0])
+    for i in (1, 2):
+      iters = jnp.sum(div.errors[i] > 0)
+      iters_default = jnp.sum(div_default.errors[i] > 0)
+      self.assertGreater(iters, iters_default)
+    self.assertAllClose(div.divergence, div_default.divergence, rtol=1e-2,
+                        atol=1e-2)
+
+  def test_fixed_number_of_iterations(self):
+    rngs = jax.random.split(self.rng, 2)
+    cloud_a = jax.random.uniform(rngs[0], (self._num_points[0], self._dim))
+    cloud_b = jax.random.uniform(rngs[1], (self._num_points[1], self._dim))
+    div = sinkhorn_divergence.sinkhorn_divergence(
+        pointcloud.PointCloud,
+        cloud_a,
+        cloud_b,
+        a=self._a,
+        b=self._b,
+        n_iters=50,
+        sinkhorn_kwargs=dict(inner_iterations=10))
+    self.assertGreater(div.divergence, 0.0)
+    # No error is padded with -1, since iterations are not stopped early.
+    for errors in div.errors:
+      self.assertEqual(errors.shape[0], 5)
+      self.assertFalse(jnp.any(errors == -1))
+
+    with self.assertWarns(RuntimeWarning):
+      sinkhorn_divergence.sinkhorn_divergence(
+          pointcloud.PointCloud,
+          cloud_a,
+          cloud_b,
+          n_iters=50,
+          sinkhorn_kwargs=dict(threshold=1e-2))
+
+    # n_iters does not override a bound set by the user.
+    with self.assertWarns(RuntimeWarning):
+      div = sinkhorn_divergence.sinkhorn_divergence(
+          pointcloud.PointCloud,
+          cloud_a,
+          cloud_b,
+          n_iters=200,
+          sinkhorn_kwargs=dict(max_iterations=50, inner_iterations=10))
+    for errors in div.errors:
+      self.assertEqual(errors.shape[0], 5)
+
+  @parameterized.parameters([pointcloud.PointCloud, geometry.Geometry])
+  def test_jit(self, geom_cls):
+    rngs = jax.random.split(self.rng, 2)
+    x = jax.random.uniform(rngs[0], (self._num_points[0], self._dim))
+    y = jax.random.uniform(rngs[1], (self._num_points[1], self._dim))
+    if geom_cls is pointcloud.PointCloud:
+      args = (x, y)
+    else:
+      args = tuple(pointcloud.PointCloud(u, v).cost_matrix
+                   for u, v in ((x, y), (x, x), (y, y)))
+    sinkhorn_kwargs = dict(
+        threshold=1e-2, linear_solve_kwargs=dict(ridge_identity=1e-6))
+    # Nested dicts of keyword arguments are also static under jit.
+    symmetric_sinkhorn_kwargs = dict(
+        linear_solve_kwargs=dict(ridge_identity=1e-6))
+    div = sinkhorn_divergence.sinkhorn_divergence(
+        geom_cls, *args, a=self._a, b=self._b,
+        sinkhorn_kwargs=sinkhorn_kwargs,
+        symmetric_sinkhorn_kwargs=symmetric_sinkhorn_kwargs)
+    div_jit = sinkhorn_divergence.sinkhorn_divergence(
+        geom_cls, *args, a=self._a, b=self._b,
+        sinkhorn_kwargs=sinkhorn_kwargs,
+        symmetric_sinkhorn_kwargs=symmetric_sinkhorn_kwargs, jit=True)
+    self.assertAllClose(div.divergence, div_jit.divergence, rtol=1e-4,
+                        atol=1e-4)
+    self.assertLen(div_jit.potentials, 3)
+
+  def test_geometries_cache(self):
+    rngs = jax.random.split(self.rng, 2)
+    x = jax.random.uniform(rngs[0], (self._num_points[0], self._dim))
+    y = jax.random.uniform(rngs[1], (self._num_points[1], self._dim))
+    sinkhorn_divergence.clear_geometries_cache()
+    div = sinkhorn_divergence.sinkhorn_divergence(
+        pointcloud.PointCloud, x, y, epsilon=0.1, cache_geometries=True)
+    div_cached = sinkhorn_divergence.sinkhorn_divergence(
+        pointcloud.PointCloud, x, y, epsilon=0.1, cache_geometries=True)
+    for geom, geom_cached in zip(div.geoms, div_cached.geoms):
+      self.assertIs(geom, geom_cached)
+    self.assertAllClose(div.divergence, div_cached.divergence)
+
+    # Geometries are rebuilt without caching, for different parameters or
+    # after clearing.
+    div_uncached = sinkhorn_divergence.sinkhorn_divergence(
+        pointcloud.PointCloud, x, y, epsilon=0.1)
+    self.assertIsNot(div.geoms[0], div_uncached.geoms[0])
+    div_other = sinkhorn_divergence.sinkhorn_divergence(
+        pointcloud.PointCloud, x, y, epsilon=0.2, cache_geometries=True)
+    self.assertIsNot(div.geoms[0], div_other.geoms[0])
+    sinkhorn_divergence.clear_geometries_cache()
+    div_cleared = sinkhorn_divergence.sinkhorn_divergence(
+        pointcloud.PointCloud, x, y, epsilon=0.1, cache_geometries=True)
+    self.assertIsNot(div.geoms[0], div_cleared.geoms[0])
+
+  def test_geometries_cache_unhashable_kwargs(self):
+    # Unhashable geometry kwargs are supported, but geometries are not cached.
+    rngs = jax.random.split(self.rng, 2)
+    x = jax.random.uniform(rngs[0], (self._num_points[0], self._dim))
+    y = jax.random.uniform(rngs[1], (self._num_points[1], self._dim))
+    sinkhorn_divergence.clear_geometries_cache()
+
+    costs = [pointcloud.PointCloud(u, v).cost_matrix
+             for u, v in ((x, y), (x, x), (y, y))]
+    divs = [sinkhorn_divergence.sinkhorn_divergence(
+        geometry.Geometry, cost_matrix=costs, epsilon=0.1, a=self._a,
+        b=self._b, cache_geometries=True) for _ in range(2)]
+    self.assertGreater(divs[0].divergence, 0.0)
+    self.assertIsNot(divs[0].geoms[0], divs[1].geoms[0])
+    self.assertAllClose(divs[0].divergence, divs[1].divergence)
+
+    epsilon = jnp.array(0.1)
+    divs = [sinkhorn_divergence.sinkhorn_divergence(
+        pointcloud.PointCloud, x, y, epsilon=epsilon, a=self._a, b=self._b,
+        cache_geometries=True) for _ in range(2)]
+    self.assertGreater(divs[0].divergence, 0.0)
+    self.assertIsNot(divs[0].geoms[0], divs[1].geoms[0])
+    self.assertAllClose(divs[0].divergence, divs[1].divergence)
+
+  def test_geometries_cache_numpy_inputs(self):
+    # numpy arrays can be modified in place, so their geometries are not cached.
+    rngs = jax.random.split(self.rng, 2)
+    x = np.array(jax.random.uniform(rngs[0], (self._num_points[0], self._dim)))
+    y = np.array(jax.random.uniform(rngs[1], (self._num_points[1], self._dim)))
+    sinkhorn_divergence.clear_geometries_cache()
+    div = sinkhorn_divergence.sinkhorn_divergence(
+        pointcloud.PointCloud, x, y, epsilon=0.1, cache_geometries=True)
+    x += 1.0
+    div_shifted = sinkhorn_divergence.sinkhorn_divergence(
+        pointcloud.PointCloud, x, y, epsilon=0.1, cache_geometries=True)
+    self.assertIsNot(div.geoms[0], div_shifted.geoms[0])
+    self.assertGreater(div_shifted.divergence, div.divergence)
+
 if __name__ == '__main__':
   absltest.main()